@@ -3,24 +3,24 @@ import tempfile
 import numpy as np
 import re
 import img2pdf
-from tqdm import tqdm
+import multiprocessing
 from functools import partial
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 
 os.environ['VLLM_USE_V1'] = '0'
 
+import anyio
 import httpx
 import asyncio
 import base64
+import hashlib
 import io
-import json
+import orjson
 import time
 import uuid
 from contextlib import asynccontextmanager
 from typing import Optional, List
 
-import fitz
-
 from fastapi import FastAPI, UploadFile, Form
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
@@ -32,15 +32,46 @@ from deepseek_ocr2 import DeepseekOCR2ForCausalLM
 ModelRegistry.register_model("DeepseekOCR2ForCausalLM", DeepseekOCR2ForCausalLM)
 
 from vllm import AsyncLLMEngine, SamplingParams
+from vllm.sampling_params import RequestOutputKind
 from vllm.engine.arg_utils import AsyncEngineArgs
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCR2Processor
+from process import pdf_process
 from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, HTMLResponse
 
 engine = None
+http_client = None
 processor = DeepseekOCR2Processor()
+default_font = ImageFont.load_default()
+# pdf rasterization and page preprocessing are CPU bound, keep them out of the event loop.
+# Workers are spawned so they never inherit the engine's CUDA context. Start the server with
+# `python -m uvicorn openai_server:app --host 0.0.0.0 --port 8000` (as the Dockerfile does) so they
+# only import process/pdf_process.py: spawn would re-import this module in every worker if it were __main__.
+# Each worker holds its own tokenizer, so the pool is sized on its own rather than by NUM_WORKERS.
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", min(4, os.cpu_count() or 1)))
+preprocess_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS,
+                                      mp_context=multiprocessing.get_context("spawn"),
+                                      initializer=pdf_process.init_worker)
+# in-flight request tasks by content hash, see run_deduplicated
+inflight_requests = {}
+# caps how many pdf pages are in flight in the engine at once
+generate_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+REF_DET_RE = re.compile(r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)', re.DOTALL)
+# 匹配detection块
+DET_BLOCK_RE = re.compile(
+    r"<\|ref\|>(?P<label>.*?)<\|/ref\|>\s*<\|det\|>\s*(?P<coords>\[.*?\])\s*<\|/det\|>",
+    re.DOTALL,
+)
+GROUND_CLEAN_RE = re.compile(r"<\|ref\|>(.*?)<\|/ref\|>\s*<\|det\|>\s*\[.*\]\s*<\|/det\|>", re.DOTALL)
+GROUNDING_TAG_RE = re.compile(r"<\|grounding\|>")
+FIXUPS = {'\\coloneqq': ':=', '\\eqqcolon': '=:'}
+# anything not in FIXUPS is a run of blank lines, collapsed to one
+FIXUPS_RE = re.compile(r'\\coloneqq|\\eqqcolon|\n{3,}')
+# numbers inside a det coordinate list
+NUM_RE = re.compile(r"-?\d+(?:\.\d+)?")
 
 logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids={128821,
                                                                                                       128822})]  # window for fast；whitelist_token_ids: <td>,</td>
@@ -48,7 +79,13 @@ logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50,
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    global engine
+    global engine, http_client
+    # one pooled HTTP/2 client for all remote image / pdf downloads
+    http_client = httpx.AsyncClient(http2=True, timeout=30,
+                                    limits=httpx.Limits(max_connections=NUM_WORKERS * 4,
+                                                        max_keepalive_connections=64))
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
     engine_args = AsyncEngineArgs(
         model=MODEL_PATH,
         hf_overrides={"architectures": ["DeepseekOCR2ForCausalLM"]},
@@ -58,9 +95,17 @@ async def lifespan(app: FastAPI):
         tensor_parallel_size=int(os.environ.get("TENSOR_PARALLEL_SIZE", "1")),
         gpu_memory_utilization=float(os.environ.get("GPU_MEMORY_UTILIZATION", "0.90")),
     )
+    # spawn and initialize every preprocessing worker while the engine loads, not on the first pdf
+    loop = asyncio.get_running_loop()
+    pool_warmup = asyncio.gather(*[
+        loop.run_in_executor(preprocess_pool, pdf_process.worker_ready) for _ in range(PREPROCESS_WORKERS)
+    ])
     engine = AsyncLLMEngine.from_engine_args(engine_args)
+    await pool_warmup
     yield
-    # Shutdown (cleanup if needed)
+    # Shutdown
+    await http_client.aclose()
+    preprocess_pool.shutdown(wait=False, cancel_futures=True)
 
 
 app = FastAPI(title="DeepSeek-OCR-2 OpenAI API", lifespan=lifespan)
@@ -125,51 +170,97 @@ async def extract_image_and_text(messages):
     image = None
     text = ""
     pdf_bytes = None
+    urls = []
+
+    for msg in messages:
+        content = msg.get("content", "")
+        if isinstance(content, str):
+            text += content
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        for msg in messages:
-            content = msg.get("content", "")
-            if isinstance(content, str):
-                text += content
-
-            elif isinstance(content, list):
-                for item in content:
-                    if not isinstance(item, dict):
-                        continue
-
-                    if item.get("type") == "text":
-                        text += item.get("text", "")
-
-                    elif item.get("type") == "image_url":
-                        url = item.get("image_url", {}).get("url", "")
-                        if not url:
-                            continue
-
-                        # base64
-                        if url.startswith("data:"):
-                            base64_data = url.split(",", 1)[1]
-                            image_bytes = base64.b64decode(base64_data)
-                            if image_bytes.startswith(b'%PDF-'):
-                                pdf_bytes = image_bytes
-                            else:
-                                image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-
-                        # remote http(s)
-                        elif url.startswith("http://") or url.startswith("https://"):
-                            resp = await client.get(url)
-                            resp.raise_for_status()
-                            content_type = resp.headers.get('content-type', '').lower()
-                            if 'application/pdf' in content_type:
-                                pdf_bytes = resp.content
-                            else:
-                                image = Image.open(io.BytesIO(resp.content)).convert("RGB")
+        elif isinstance(content, list):
+            for item in content:
+                if not isinstance(item, dict):
+                    continue
+
+                if item.get("type") == "text":
+                    text += item.get("text", "")
+
+                elif item.get("type") == "image_url":
+                    url = item.get("image_url", {}).get("url", "")
+                    if url:
+                        urls.append(url)
+
+    # fetch every distinct remote url concurrently over the shared client
+    remote_urls = list(dict.fromkeys(url for url in urls if url.startswith("http://") or url.startswith("https://")))
+    fetches = [asyncio.create_task(http_client.get(url)) for url in remote_urls]
+    try:
+        responses = dict(zip(remote_urls, await asyncio.gather(*fetches)))
+    finally:
+        # one fetch failed: don't leave the others running unawaited
+        for fetch in fetches:
+            fetch.cancel()
+
+    for url in urls:
+        # base64
+        if url.startswith("data:"):
+            base64_data = url.split(",", 1)[1]
+            image_bytes = base64.b64decode(base64_data)
+            if image_bytes.startswith(b'%PDF-'):
+                pdf_bytes = image_bytes
+            else:
+                image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
+        # remote http(s)
+        elif url in responses:
+            resp = responses[url]
+            resp.raise_for_status()
+            content_type = resp.headers.get('content-type', '').lower()
+            if 'application/pdf' in content_type:
+                pdf_bytes = resp.content
+            else:
+                image = Image.open(io.BytesIO(resp.content)).convert("RGB")
 
     return image, text, pdf_bytes
 
+def inflight_key(*parts):
+    """Content hash identifying a request, used to coalesce identical concurrent ones"""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+async def run_deduplicated(key, coro_fn):
+    """Await coro_fn(), or join the run already in flight for the same key; key None runs it unshared"""
+    if key is None:
+        return await coro_fn()
+    task = inflight_requests.get(key)
+    if task is None:
+        task = asyncio.create_task(coro_fn())
+        inflight_requests[key] = task
+
+        def forget(done_task):
+            if inflight_requests.get(key) is done_task:
+                del inflight_requests[key]
+
+        task.add_done_callback(forget)
+    # shield so one caller disconnecting does not cancel the run for the others
+    return await asyncio.shield(task)
+
 @app.post("/v1/chat/completions")
 async def chat_completions(request: ChatRequest):
+    async def complete():
+        image, text, pdf_bytes = await extract_image_and_text(request.messages)
+        return await run_chat_completion(image, text, pdf_bytes, request)
+
+    # a stream belongs to a single client, and only greedy decoding gives every caller the same answer
+    if request.stream or request.temperature:
+        return await complete()
+    return await run_deduplicated(inflight_key("chat", request.model_dump_json()), complete)
+
+async def run_chat_completion(image, text, pdf_bytes, request: ChatRequest):
+    """Complete a request whose image / text / pdf have already been extracted from the messages"""
     global engine
-    image, text, pdf_bytes = await extract_image_and_text(request.messages)
     if pdf_bytes is not None:
          return await process_pdf(pdf_bytes, request)
 
@@ -195,6 +286,7 @@ async def chat_completions(request: ChatRequest):
         temperature=request.temperature,
         max_tokens=request.max_tokens,
         skip_special_tokens=False,
+        output_kind=RequestOutputKind.DELTA,
     )
 
     request_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
@@ -205,10 +297,12 @@ async def chat_completions(request: ChatRequest):
             media_type="text/event-stream"
         )
     else:
-        full_text = ""
+        # DELTA outputs carry only the newly decoded text
+        parts = []
         async for output in engine.generate(request_dict, sampling_params, request_id):
             if output.outputs:
-                full_text = output.outputs[0].text
+                parts.append(output.outputs[0].text)
+        full_text = "".join(parts)
 
         orig_w, orig_h = image.size
         return {
@@ -225,32 +319,34 @@ async def chat_completions(request: ChatRequest):
         }
 
 
-async def stream_response(request_dict, sampling_params, request_id, model):
-    prev_len = 0
-    async for output in engine.generate(request_dict, sampling_params, request_id):
-        if output.outputs:
-            full_text = output.outputs[0].text
-            delta = full_text[prev_len:]
-            prev_len = len(full_text)
-            if delta:
-                chunk = {
-                    "id": request_id,
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": model,
-                    "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]
-                }
-                yield f"data: {json.dumps(chunk)}\n\n"
-
-    chunk = {
+def sse_chunk_prefix(request_id, model):
+    """Serialize the static part of a chat.completion.chunk once per request, left open for "choices" """
+    return orjson.dumps({
         "id": request_id,
         "object": "chat.completion.chunk",
         "created": int(time.time()),
         "model": model,
-        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
-    }
-    yield f"data: {json.dumps(chunk)}\n\n"
-    yield "data: [DONE]\n\n"
+    })[:-1]
+
+def sse_delta_chunk(chunk_prefix, delta, page=None):
+    # pdf streams tag each delta with its page in a top-level "page" field; choices[].index stays 0
+    page_field = b'' if page is None else b',"page":' + str(page).encode()
+    return (b'data: ' + chunk_prefix + page_field + b',"choices":[{"index":0,"delta":{"content":'
+            + orjson.dumps(delta) + b'},"finish_reason":null}]}\n\n')
+
+def sse_stop_chunk(chunk_prefix):
+    return (b'data: ' + chunk_prefix + b',"choices":[{"index":0,"delta":{},"finish_reason":"stop"}]}\n\n'
+            b'data: [DONE]\n\n')
+
+async def stream_response(request_dict, sampling_params, request_id, model):
+    chunk_prefix = sse_chunk_prefix(request_id, model)
+    async for output in engine.generate(request_dict, sampling_params, request_id):
+        if output.outputs:
+            delta = output.outputs[0].text
+            if delta:
+                yield sse_delta_chunk(chunk_prefix, delta)
+
+    yield sse_stop_chunk(chunk_prefix)
 
 async def process_pdf(pdf_bytes, request: ChatRequest):
     """
@@ -272,288 +368,297 @@ async def process_pdf(pdf_bytes, request: ChatRequest):
             "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
         }
     else:
-        stream_ocr_pdf_handle(pdf_bytes, request)
-
-def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
-    """
-    pdf2images
-    """
-    images = []
-
-    pdf_document = fitz.open(pdf_path)
-
-    zoom = dpi / 72.0
-    matrix = fitz.Matrix(zoom, zoom)
-
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
-
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
-
-        if image_format.upper() == "PNG":
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-        else:
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
+        return StreamingResponse(
+            stream_ocr_pdf_handle(pdf_bytes, request),
+            media_type="text/event-stream"
+        )
 
-        images.append(img)
+def parse_boxes(coords_str):
+    """Split a det coordinate string such as [[x1, y1, x2, y2], ...] into boxes of 4 numbers"""
+    nums = [float(n) for n in NUM_RE.findall(coords_str)]
+    return [nums[i:i + 4] for i in range(0, len(nums) - 3, 4)]
 
-    pdf_document.close()
-    return images
+def scale_boxes(boxes, image_width, image_height):
+    """Scale 0-999 normalized boxes to pixel coordinates in one vectorized pass"""
+    if not boxes:
+        return []
+    dims = np.array([image_width, image_height, image_width, image_height])
+    return (np.asarray(boxes, dtype=np.float64) / 999 * dims).astype(np.int32).tolist()
 
 def extract_coordinates_and_label(ref_text, image_width, image_height):
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
+    label_type = ref_text[1]
+    cor_list = parse_boxes(ref_text[2])
+    if not cor_list:
         return None
 
     return (label_type, cor_list)
 
-def draw_bounding_boxes(image, refs, jdx):
-    image_width, image_height = image.size
-    img_draw = image.copy()
-    draw = ImageDraw.Draw(img_draw)
+def draw_bounding_boxes(page, refs, jdx):
+    """Draw refs on a PIL copy of the page array; image crops come from the untouched array"""
+    image_height, image_width = page.shape[:2]
+    img_draw = Image.fromarray(page)
+    # RGBA draw on an RGB image blends translucent fills in place, no separate overlay to composite
+    draw = ImageDraw.Draw(img_draw, 'RGBA')
 
-    overlay = Image.new('RGBA', img_draw.size, (0, 0, 0, 0))
-    draw2 = ImageDraw.Draw(overlay)
-
-    #     except IOError:
-    font = ImageFont.load_default()
+    font = default_font
 
     img_idx = 0
 
-    for i, ref in enumerate(refs):
-        try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if result:
-                label_type, points_list = result
-
-                color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
-
-                color_a = color + (20,)
-                for points in points_list:
-                    x1, y1, x2, y2 = points
-
-                    x1 = int(x1 / 999 * image_width)
-                    y1 = int(y1 / 999 * image_height)
-
-                    x2 = int(x2 / 999 * image_width)
-                    y2 = int(y2 / 999 * image_height)
-
-                    if label_type == 'image':
-                        try:
-                            cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{jdx}_{img_idx}.jpg")
-                        except Exception as e:
-                            print(e)
-                            pass
-                        img_idx += 1
-
-                    try:
-                        if label_type == 'title':
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-                        else:
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-
-                        text_x = x1
-                        text_y = max(0, y1 - 15)
-
-                        text_bbox = draw.textbbox((0, 0), label_type, font=font)
-                        text_width = text_bbox[2] - text_bbox[0]
-                        text_height = text_bbox[3] - text_bbox[1]
-                        draw.rectangle([text_x, text_y, text_x + text_width, text_y + text_height],
-                                       fill=(255, 255, 255, 30))
-
-                        draw.text((text_x, text_y), label_type, font=font, fill=color)
-                    except:
-                        pass
-        except:
-            continue
-    img_draw.paste(overlay, (0, 0), overlay)
+    parsed_refs = []
+    for ref in refs:
+        result = extract_coordinates_and_label(ref, image_width, image_height)
+        if result:
+            parsed_refs.append(result)
+
+    # rescale every box on the page at once, then walk them back per ref
+    scaled = scale_boxes([points for _, points_list in parsed_refs for points in points_list],
+                         image_width, image_height)
+    box_idx = 0
+
+    # only a handful of distinct labels per page: measure and color each one once
+    label_sizes = {}
+    label_colors = {}
+    for label_type, _ in parsed_refs:
+        if label_type not in label_sizes:
+            try:
+                text_bbox = draw.textbbox((0, 0), label_type, font=font)
+                label_sizes[label_type] = (text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1])
+            except Exception:
+                # e.g. non latin-1 labels with the bitmap default font
+                label_sizes[label_type] = None
+            label_colors[label_type] = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
+
+    for label_type, points_list in parsed_refs:
+        color = label_colors[label_type]
+
+        color_a = color + (20,)
+        ref_boxes = scaled[box_idx:box_idx + len(points_list)]
+        box_idx += len(points_list)
+        for x1, y1, x2, y2 in ref_boxes:
+            if label_type == 'image':
+                try:
+                    cropped = Image.fromarray(page[max(0, y1):y2, max(0, x1):x2])
+                    cropped.save(f"{OUTPUT_PATH}/images/{jdx}_{img_idx}.jpg")
+                except Exception as e:
+                    print(e)
+                    pass
+                img_idx += 1
+
+            try:
+                if label_type == 'title':
+                    draw.rectangle([x1, y1, x2, y2], fill=color_a, outline=color, width=4)
+                else:
+                    draw.rectangle([x1, y1, x2, y2], fill=color_a, outline=color, width=2)
+
+                text_x = x1
+                text_y = max(0, y1 - 15)
+
+                if label_sizes[label_type] is None:
+                    continue
+                text_width, text_height = label_sizes[label_type]
+                draw.rectangle([text_x, text_y, text_x + text_width, text_y + text_height],
+                               fill=(255, 255, 255))
+
+                draw.text((text_x, text_y), label_type, font=font, fill=color)
+            except:
+                pass
     return img_draw
 
 def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
+    matches = []
     mathes_image = []
     mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
+    # single pass, split on the label group rather than re-scanning each match
+    for m in REF_DET_RE.finditer(text):
+        full, label = m.group(1), m.group(2)
+        matches.append((full, label, m.group(3)))
+        (mathes_image if label == 'image' else mathes_other).append(full)
     return matches, mathes_image, mathes_other
 
-def process_image_with_refs(image, ref_texts, jdx):
-    result_image = draw_bounding_boxes(image, ref_texts, jdx)
+def process_image_with_refs(page, ref_texts, jdx):
+    result_image = draw_bounding_boxes(page, ref_texts, jdx)
     return result_image
 
-def pil_to_pdf_img2pdf(pil_images, output_path):
-    if not pil_images:
-        return
+def encode_jpeg(img):
+    """encode one layout page for img2pdf, which embeds the jpeg stream as is"""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
 
-    image_bytes_list = []
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='JPEG', quality=85, optimize=False, progressive=False)
+    return img_buffer.getvalue()
 
-    for img in pil_images:
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
+async def pil_to_pdf_img2pdf(pil_images, output_path):
+    if not pil_images:
+        return
 
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='JPEG', quality=95)
-        img_bytes = img_buffer.getvalue()
-        image_bytes_list.append(img_bytes)
+    # encode every page exactly once; PIL releases the GIL while encoding, so worker threads
+    # run in parallel without shipping the drawn pages to another process
+    image_bytes_list = await asyncio.gather(*[
+        anyio.to_thread.run_sync(encode_jpeg, img) for img in pil_images
+    ])
 
     try:
-        pdf_bytes = img2pdf.convert(image_bytes_list)
-        with open(output_path, "wb") as f:
-            f.write(pdf_bytes)
+        pdf_bytes = await anyio.to_thread.run_sync(img2pdf.convert, image_bytes_list)
+        async with await anyio.open_file(output_path, "wb") as f:
+            await f.write(pdf_bytes)
 
     except Exception as e:
         print(f"error: {e}")
 
-def process_single_image(image, prompt):
-    """single image"""
-    if image and '<image>' not in prompt:
-        prompt_in = f"<image>\n{prompt}"
-    else:
-        prompt_in = prompt
-    cache_item = {
-        "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCR2Processor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
-    }
-    return cache_item
+async def preprocess_pdf(pdf_path, prompt):
+    """Rasterize and tokenize every page in the process pool, off the event loop"""
+    loop = asyncio.get_running_loop()
+    page_count = await loop.run_in_executor(preprocess_pool, pdf_process.pdf_page_count, pdf_path)
 
-async def ocr_pdf_handle(pdf_bytes, request: ChatRequest):
-    tmp_file_path = None
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(pdf_bytes)
-            tmp_file_path = tmp_file.name
+    # one contiguous page range per worker, so each opens the document once and
+    # only the finished pages and their tokens come back
+    range_size = max(1, -(-page_count // PREPROCESS_WORKERS))
+    ranges = await asyncio.gather(*[
+        loop.run_in_executor(preprocess_pool, pdf_process.process_pages, pdf_path,
+                             start, min(start + range_size, page_count), prompt)
+        for start in range(0, page_count, range_size)
+    ])
 
-        images = pdf_to_images_high_quality(tmp_file_path)
+    images = []
+    batch_inputs = []
+    for page, batch_input in (result for results in ranges for result in results):
+        batch_input["multi_modal_data"]["image"] = pdf_process.features_to_torch(batch_input["multi_modal_data"]["image"])
+        images.append(page)
+        batch_inputs.append(batch_input)
+    return images, batch_inputs
+
+async def generate_page(batch_input, sampling_params, request_id, delta_queue=None, page_idx=None):
+    """Run one page through the engine and return its final text.
+
+    When ``delta_queue`` is given, every new piece of text is pushed to it as
+    ``(page_idx, delta)`` so the caller can stream pages as they decode.
+    """
+    parts = []
+    async with generate_semaphore:
+        async for output in engine.generate(batch_input, sampling_params, request_id):
+            if output.outputs:
+                delta = output.outputs[0].text
+                if delta:
+                    parts.append(delta)
+                    if delta_queue is not None:
+                        delta_queue.put_nowait((page_idx, delta))
+    return ''.join(parts)
+
+def render_pdf_pages(images, page_outputs):
+    """Draw each page's layout, save its image crops and build both markdown texts; runs in a worker thread"""
+    contents_det_parts = []
+    contents_parts = []
+    draw_images = []
+    jdx = 0
+    for content, img in zip(page_outputs, images):
+        if '<｜end▁of▁sentence｜>' in content:  # repeat no eos
+            content = content.replace('<｜end▁of▁sentence｜>', '')
+        else:
+            if SKIP_REPEAT:
+                continue
 
-        process_fn = partial(process_single_image, prompt=request.messages[0]["content"][0]["text"])
+        page_num = f'\n<--- Page Split --->'
 
-        with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-            batch_inputs = list(tqdm(
-                executor.map(process_fn, images),
-                total=len(images),
-                desc="Pre-processed images"
-            ))
+        contents_det_parts.append(content + f'\n{page_num}\n')
 
-        sampling_params = SamplingParams(
-            temperature=request.temperature,
-            max_tokens=request.max_tokens,
-            logits_processors=logits_processors,
-            skip_special_tokens=False,
-            include_stop_str_in_output=True,
-        )
+        matches_ref, matches_images, mathes_other = re_match(content)
+        # print(matches_ref)
+        # draw_bounding_boxes makes the only copy of the page it draws on
+        result_image = process_image_with_refs(img, matches_ref, jdx)
 
-        outputs_list = []
-        request_id = f"pdfocr-{uuid.uuid4().hex[:8]}"
-        for batch_input in batch_inputs:
-            async for output in engine.generate(batch_input, sampling_params, request_id):
-                outputs_list.append(output)
+        draw_images.append(result_image)
 
-        output_path = OUTPUT_PATH
+        for idx, a_match_image in enumerate(matches_images):
+            content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
 
-        os.makedirs(output_path, exist_ok=True)
-        os.makedirs(f'{output_path}/images', exist_ok=True)
+        if mathes_other:
+            # drop every non-image ref in one pass, then apply the text fixups in another
+            other_re = re.compile('|'.join(map(re.escape, dict.fromkeys(mathes_other))))
+            content = other_re.sub('', content)
+            content = FIXUPS_RE.sub(lambda m: FIXUPS.get(m.group(0), '\n\n'), content)
 
-        mmd_det_path = output_path + '/' + request_id + '_det.md'
-        mmd_path = output_path + '/' + request_id + '.md'
-        pdf_out_path = output_path + '/' + request_id + '_layouts.pdf'
-        contents_det = ''
-        contents = ''
-        draw_images = []
-        jdx = 0
-        for batch_input, img in zip(batch_inputs, images):
-            async for output in engine.generate(batch_input, sampling_params, request_id):
-                if output.outputs:
-                    content = output.outputs[0].text
-                    if '<｜end▁of▁sentence｜>' in content:  # repeat no eos
-                        content = content.replace('<｜end▁of▁sentence｜>', '')
-                    else:
-                        if SKIP_REPEAT:
-                            continue
+        contents_parts.append(content + f'\n{page_num}\n')
 
-                    page_num = f'\n<--- Page Split --->'
+        jdx += 1
 
-                    contents_det += content + f'\n{page_num}\n'
+    return ''.join(contents_det_parts), ''.join(contents_parts), draw_images
 
-                    image_draw = img.copy()
+async def save_pdf_results(request_id, images, page_outputs):
+    """Draw layouts and write the markdown / layout pdf for a finished document"""
+    output_path = OUTPUT_PATH
 
-                    matches_ref, matches_images, mathes_other = re_match(content)
-                    # print(matches_ref)
-                    result_image = process_image_with_refs(image_draw, matches_ref, jdx)
+    mmd_det_path = output_path + '/' + request_id + '_det.md'
+    mmd_path = output_path + '/' + request_id + '.md'
+    pdf_out_path = output_path + '/' + request_id + '_layouts.pdf'
+    # drawing, cropping and the crop jpeg writes are all blocking, keep them off the event loop
+    contents_det, contents, draw_images = await anyio.to_thread.run_sync(render_pdf_pages, images, page_outputs)
 
-                    draw_images.append(result_image)
+    async with await anyio.open_file(mmd_det_path, 'w', encoding='utf-8') as afile:
+        await afile.write(contents_det)
 
-                    for idx, a_match_image in enumerate(matches_images):
-                        content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
+    async with await anyio.open_file(mmd_path, 'w', encoding='utf-8') as afile:
+        await afile.write(contents)
 
-                    for idx, a_match_other in enumerate(mathes_other):
-                        content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon',
-                                                                                                         '=:').replace(
-                            '\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
+    await pil_to_pdf_img2pdf(draw_images, pdf_out_path)
 
-                    contents += content + f'\n{page_num}\n'
+    return {
+        "code": 200,
+        "success": True,
+        "images": len(images),
+        "text": contents,
+        "raw_text": contents_det,
+        "mmd_det_path": mmd_det_path,
+        "mmd_path": mmd_path,
+        "pdf_out_path": pdf_out_path,
+    }
 
-                    jdx += 1
+async def ocr_pdf_handle(pdf_bytes, request: ChatRequest):
+    tmp_file_path = None
+    page_tasks = []
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
+            tmp_file.write(pdf_bytes)
+            tmp_file_path = tmp_file.name
 
-        with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-            afile.write(contents_det)
+        images, batch_inputs = await preprocess_pdf(tmp_file_path, request.messages[0]["content"][0]["text"])
 
-        with open(mmd_path, 'w', encoding='utf-8') as afile:
-            afile.write(contents)
+        sampling_params = SamplingParams(
+            temperature=request.temperature,
+            max_tokens=request.max_tokens,
+            logits_processors=logits_processors,
+            skip_special_tokens=False,
+            include_stop_str_in_output=True,
+            output_kind=RequestOutputKind.DELTA,
+        )
 
-        pil_to_pdf_img2pdf(draw_images, pdf_out_path)
+        request_id = f"pdfocr-{uuid.uuid4().hex[:8]}"
 
-        return {
-            "code": 200,
-            "success": True,
-            "images": len(images),
-            "text": contents,
-            "raw_text": contents_det,
-            "mmd_det_path": mmd_det_path,
-            "mmd_path": mmd_path,
-            "pdf_out_path": pdf_out_path,
-        }
+        # submit every page at once so the engine can batch them together
+        page_tasks = [
+            asyncio.create_task(generate_page(batch_input, sampling_params, f"{request_id}-{page_idx}"))
+            for page_idx, batch_input in enumerate(batch_inputs)
+        ]
+        page_outputs = await asyncio.gather(*page_tasks)
+
+        return await save_pdf_results(request_id, images, page_outputs)
     finally:
+        # a page failed or the request was cancelled: stop the remaining generations
+        for task in page_tasks:
+            task.cancel()
         if tmp_file_path and os.path.exists(tmp_file_path):
             os.unlink(tmp_file_path)
 
 async def stream_ocr_pdf_handle(pdf_bytes, request: ChatRequest):
     model = request.model
-    prev_len = 0
     tmp_file_path = None
+    tasks = []
     try:
         with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
             tmp_file.write(pdf_bytes)
             tmp_file_path = tmp_file.name
 
-        images = pdf_to_images_high_quality(tmp_file_path)
-
-        process_fn = partial(process_single_image, prompt=request.messages[0]["content"][0]["text"])
-
-        with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-            batch_inputs = list(tqdm(
-                executor.map(process_fn, images),
-                total=len(images),
-                desc="Pre-processed images"
-            ))
+        images, batch_inputs = await preprocess_pdf(tmp_file_path, request.messages[0]["content"][0]["text"])
 
         sampling_params = SamplingParams(
             temperature=request.temperature,
@@ -561,151 +666,80 @@ async def stream_ocr_pdf_handle(pdf_bytes, request: ChatRequest):
             logits_processors=logits_processors,
             skip_special_tokens=False,
             include_stop_str_in_output=True,
+            output_kind=RequestOutputKind.DELTA,
         )
         request_id = f"pdfocr-{uuid.uuid4().hex[:8]}"
-
-        output_path = OUTPUT_PATH
-
-        os.makedirs(output_path, exist_ok=True)
-        os.makedirs(f'{output_path}/images', exist_ok=True)
-
-        mmd_det_path = output_path + '/' + request_id + '_det.md'
-        mmd_path = output_path + '/' + request_id + '.md'
-        pdf_out_path = output_path + '/' + request_id + '_layouts.pdf'
-        contents_det = ''
-        contents = ''
-        draw_images = []
-        jdx = 0
-        for batch_input, img in zip(batch_inputs, images):
-            async for output in engine.generate(batch_input, sampling_params, request_id):
-                if output.outputs:
-                    full_text = output.outputs[0].text
-                    delta = full_text[prev_len:]
-                    prev_len = len(full_text)
-                    if delta:
-                        chunk = {
-                            "id": request_id,
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": model,
-                            "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]
-                        }
-                        yield f"data: {json.dumps(chunk)}\n\n"
-
-                    if '<｜end▁of▁sentence｜>' in content:  # repeat no eos
-                        content = content.replace('<｜end▁of▁sentence｜>', '')
-                    else:
-                        if SKIP_REPEAT:
-                            continue
-
-                    page_num = f'\n<--- Page Split --->'
-
-                    contents_det += content + f'\n{page_num}\n'
-
-                    image_draw = img.copy()
-
-                    matches_ref, matches_images, mathes_other = re_match(content)
-                    # print(matches_ref)
-                    result_image = process_image_with_refs(image_draw, matches_ref, jdx)
-
-                    draw_images.append(result_image)
-
-                    for idx, a_match_image in enumerate(matches_images):
-                        content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
-
-                    for idx, a_match_other in enumerate(mathes_other):
-                        content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon',
-                                                                                                         '=:').replace(
-                            '\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
-
-                    contents += content + f'\n{page_num}\n'
-
-                    jdx += 1
-
-        with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-            afile.write(contents_det)
-
-        with open(mmd_path, 'w', encoding='utf-8') as afile:
-            afile.write(contents)
-
-        pil_to_pdf_img2pdf(draw_images, pdf_out_path)
-
-        chunk = {
-            "id": request_id,
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
-        }
-        yield f"data: {json.dumps(chunk)}\n\n"
-        yield "data: [DONE]\n\n"
+        chunk_prefix = sse_chunk_prefix(request_id, model)
+
+        # pages decode concurrently and push their deltas here; None marks the end
+        delta_queue = asyncio.Queue()
+        page_tasks = [
+            asyncio.create_task(generate_page(batch_input, sampling_params, f"{request_id}-{page_idx}",
+                                              delta_queue, page_idx))
+            for page_idx, batch_input in enumerate(batch_inputs)
+        ]
+
+        async def wait_pages():
+            try:
+                return await asyncio.gather(*page_tasks)
+            finally:
+                delta_queue.put_nowait(None)
+
+        pages_task = asyncio.create_task(wait_pages())
+        tasks = page_tasks + [pages_task]
+
+        while True:
+            item = await delta_queue.get()
+            if item is None:
+                break
+            page_idx, delta = item
+            yield sse_delta_chunk(chunk_prefix, delta, page=page_idx)
+
+        page_outputs = await pages_task
+        await save_pdf_results(request_id, images, page_outputs)
+
+        yield sse_stop_chunk(chunk_prefix)
     finally:
+        # client went away or a page failed: stop the remaining generations
+        for task in tasks:
+            task.cancel()
         if tmp_file_path and os.path.exists(tmp_file_path):
             os.unlink(tmp_file_path)
 
 async def download_file(url):
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.get(url)
-        pdf_bytes = resp.content
-        content_type = resp.headers.get('content-type', '').lower()
-        if 'application/pdf' in content_type:
-            return pdf_bytes, 'pdf'
-        else:
-            return pdf_bytes, 'image'
+    resp = await http_client.get(url)
+    pdf_bytes = resp.content
+    content_type = resp.headers.get('content-type', '').lower()
+    if 'application/pdf' in content_type:
+        return pdf_bytes, 'pdf'
+    else:
+        return pdf_bytes, 'image'
 
 
 def clean_grounding_text(text: str) -> str:
     """移除grounding标记，保留标签"""
-    cleaned = re.sub(
-        r"<\|ref\|>(.*?)<\|/ref\|>\s*<\|det\|>\s*\[.*\]\s*<\|/det\|>",
-        r"\1",
-        text,
-        flags=re.DOTALL,
-    )
-    cleaned = re.sub(r"<\|grounding\|>", "", cleaned)
+    cleaned = GROUND_CLEAN_RE.sub(r"\1", text)
+    cleaned = GROUNDING_TAG_RE.sub("", cleaned)
     return cleaned.strip()
 
 
 def parse_detections(text: str, image_width: int, image_height: int):
     """解析grounding boxes并缩放坐标"""
-    boxes = []
+    labels = []
+    all_boxes = []
 
-    # 匹配detection块
-    DET_BLOCK = re.compile(
-        r"<\|ref\|>(?P<label>.*?)<\|/ref\|>\s*<\|det\|>\s*(?P<coords>\[.*?\])\s*<\|/det\|>",
-        re.DOTALL,
-    )
-
-    for m in DET_BLOCK.finditer(text or ""):
+    for m in DET_BLOCK_RE.finditer(text or ""):
         label = m.group("label").strip()
         coords_str = m.group("coords").strip()
 
-        try:
-            import ast
-            parsed = ast.literal_eval(coords_str)
-
-            # 标准化为列表的列表
-            if isinstance(parsed, list) and len(parsed) == 4 and all(isinstance(n, (int, float)) for n in parsed):
-                box_coords = [parsed]
-            elif isinstance(parsed, list):
-                box_coords = parsed
-            else:
-                continue
+        # 处理每个box
+        for box in parse_boxes(coords_str):
+            labels.append(label)
+            all_boxes.append(box)
 
-            # 处理每个box
-            for box in box_coords:
-                if isinstance(box, (list, tuple)) and len(box) >= 4:
-                    # 从0-999归一化坐标转换为实际像素坐标
-                    x1 = int(float(box[0]) / 999 * image_width)
-                    y1 = int(float(box[1]) / 999 * image_height)
-                    x2 = int(float(box[2]) / 999 * image_width)
-                    y2 = int(float(box[3]) / 999 * image_height)
-                    boxes.append({"label": label, "box": [x1, y1, x2, y2]})
-        except Exception as e:
-            print(f"解析坐标失败: {e}")
-            continue
-
-    return boxes
+    # 从0-999归一化坐标转换为实际像素坐标
+    scaled = scale_boxes(all_boxes, image_width, image_height)
+    return [{"label": label, "box": box} for label, box in zip(labels, scaled)]
 
 @app.post("/ocr")
 async def ocr(
@@ -745,14 +779,20 @@ async def ocr(
     else:
         pdf_bytes = await file.read()
 
+    # sampled outputs differ per call, so only greedy requests are shared
+    key = None if temperature else inflight_key("ocr", pdf_bytes, prompt, max_tokens, temperature)
+
     content_start = pdf_bytes[:1024]
     if b'%PDF-' in content_start:
-        data = await ocr_pdf_handle(pdf_bytes, request)
+        data = await run_deduplicated(key, partial(ocr_pdf_handle, pdf_bytes, request))
         return JSONResponse(data)
 
-    pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
-    request.messages[0]['content'][1]['image_url']["url"] = f'data:image/jpeg;base64,{pdf_base64}'
-    res = await chat_completions(request)
+    async def complete():
+        # decode the upload directly rather than round-tripping it through a base64 data url
+        image = Image.open(io.BytesIO(pdf_bytes)).convert("RGB")
+        return await run_chat_completion(image, prompt, None, request)
+
+    res = await run_deduplicated(key, complete)
 
     boxes = []
     result_text = res['choices'][0]['message']['content']
@@ -786,7 +826,3 @@ async def ocr(
             "has_boxes": len(boxes) > 0
          }
      })
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
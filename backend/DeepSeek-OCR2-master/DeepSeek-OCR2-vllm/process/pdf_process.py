@@ -0,0 +1,85 @@
+import os
+
+import fitz
+import numpy as np
+import torch
+from PIL import Image
+
+from config import CROP_MODE
+from process.image_process import DeepseekOCR2Processor
+
+# Page work for the openai_server.py process pool. Kept out of the server module so
+# pool workers only import what rasterizing and tokenizing a page needs.
+
+Image.MAX_IMAGE_PIXELS = None
+
+processor = None
+
+
+def init_worker():
+    """pool initializer: one torch thread and one processor per worker"""
+    global processor
+    torch.set_num_threads(1)
+    processor = DeepseekOCR2Processor()
+
+
+def worker_ready():
+    """no-op submitted at startup so every worker is spawned and initialized up front"""
+    return os.getpid()
+
+
+def pdf_page_count(pdf_path):
+    with fitz.open(pdf_path) as pdf_document:
+        return pdf_document.page_count
+
+
+def render_page(pdf_document, page_num, dpi=144):
+    """
+    pdf page to a (height, width, 3) uint8 RGB array
+    """
+    zoom = dpi / 72.0
+    pixmap = pdf_document[page_num].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+    # alpha=False always yields packed RGB; samples is a private bytes copy, so the
+    # array outlives the pixmap and pickles back to the server as one flat buffer
+    return np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, 3)
+
+
+def features_to_numpy(features):
+    """torch tensors in tokenize_with_images output to numpy, so they pickle by value
+    instead of going through torch's /dev/shm sharing on the way back from a worker"""
+    if isinstance(features, torch.Tensor):
+        return features.numpy()
+    if isinstance(features, list):
+        return [features_to_numpy(item) for item in features]
+    return features
+
+
+def features_to_torch(features):
+    """inverse of features_to_numpy, run in the server process"""
+    if isinstance(features, np.ndarray):
+        return torch.from_numpy(features)
+    if isinstance(features, list):
+        return [features_to_torch(item) for item in features]
+    return features
+
+
+def process_pages(pdf_path, start, stop, prompt):
+    """rasterize and tokenize pages [start, stop) in the same call: the document is parsed
+    once per range and each page crosses the process boundary once"""
+    if '<image>' not in prompt:
+        prompt_in = f"<image>\n{prompt}"
+    else:
+        prompt_in = prompt
+
+    results = []
+    with fitz.open(pdf_path) as pdf_document:
+        for page_num in range(start, stop):
+            page = render_page(pdf_document, page_num)
+            cache_item = {
+                "prompt": prompt_in,
+                "multi_modal_data": {"image": features_to_numpy(processor.tokenize_with_images(
+                    images=[Image.fromarray(page)], bos=True, eos=True, cropping=CROP_MODE))},
+            }
+            results.append((page, cache_item))
+    return results